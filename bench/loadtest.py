@@ -0,0 +1,388 @@
+"""Offline load test for the bot's hot path.
+
+Starts local stand-ins for Howdies (login API + websocket), Groq (OpenAI-compatible
+completions) and Supabase (in-memory tables, or a temporary SQLite file), points app.py at them, drives
+connect_to_howdies with scripted multi-room chat traffic and reports throughput,
+reply latency percentiles, thread count and RSS.
+
+    python bench/loadtest.py --rooms 20 --users 200 --rate 50 --duration 30
+    python bench/loadtest.py --storage sqlite --db-latency-ms 0
+    python bench/loadtest.py --engine asyncio --stream --groq-latency-ms 400 --json
+"""
+import argparse
+import asyncio
+import copy
+import itertools
+import json
+import logging
+import os
+import random
+import resource
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict, deque
+
+from aiohttp import web
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BOT_USERNAME = "Enisa"
+BOT_USER_ID = 424242
+
+# ========================================================================================
+# === SUPABASE STAND-IN ==================================================================
+# ========================================================================================
+PRIMARY_KEYS = {
+    'personalities': 'name',
+    'user_behaviors': 'username',
+    'room_personalities': 'room_id',
+    'conversation_memory': 'username',
+}
+
+class FakeResponse:
+    def __init__(self, data):
+        self.data = data
+
+class FakeQuery:
+    def __init__(self, db, table):
+        self.db, self.table = db, table
+        self.operation, self.filters, self.payload, self.want_single = 'select', [], None, False
+
+    def select(self, *columns): self.operation = 'select'; return self
+    def eq(self, column, value): self.filters.append((column, lambda v, value=value: v == value)); return self
+    def in_(self, column, values): self.filters.append((column, lambda v, values=values: v in values)); return self
+    def single(self): self.want_single = True; return self
+    def upsert(self, payload, **kwargs): self.operation, self.payload = 'upsert', payload; return self
+    def delete(self): self.operation = 'delete'; return self
+
+    def _matches(self, row):
+        return all(test(row.get(column)) for column, test in self.filters)
+
+    def execute(self):
+        if self.db.latency: time.sleep(self.db.latency)
+        with self.db.lock:
+            self.db.calls[(self.table, self.operation)] += 1
+            rows = self.db.tables.setdefault(self.table, [])
+            if self.operation == 'select':
+                found = [copy.deepcopy(row) for row in rows if self._matches(row)]
+                if self.want_single:
+                    if len(found) != 1: raise RuntimeError("PGRST116: JSON object requested, multiple (or no) rows returned")
+                    return FakeResponse(found[0])
+                return FakeResponse(found)
+            if self.operation == 'upsert':
+                key = PRIMARY_KEYS.get(self.table, 'id')
+                items = self.payload if isinstance(self.payload, list) else [self.payload]
+                for item in items:
+                    existing = next((row for row in rows if row.get(key) == item.get(key)), None)
+                    if existing: existing.update(copy.deepcopy(item))
+                    else: rows.append(copy.deepcopy(item))
+                return FakeResponse(items)
+            self.db.tables[self.table] = [row for row in rows if not self._matches(row)]
+            return FakeResponse([])
+
+class FakeSupabase:
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.tables = {}
+        self.calls = defaultdict(int)
+        self.lock = threading.Lock()
+
+    def table(self, name):
+        return FakeQuery(self, name)
+
+# ========================================================================================
+# === HOWDIES + GROQ STAND-INS ===========================================================
+# ========================================================================================
+class FakeServices:
+    def __init__(self, args):
+        self.args = args
+        self.loop = None
+        self.port = None
+        self.sockets = []
+        self.room_ids = {}
+        self.room_seq = itertools.count(1000)
+        self.frames_in = 0
+        self.joins = 0
+        self.replies = 0
+        self.pending = defaultdict(deque)  # (room_id, username) -> send timestamps
+        self.latencies = []
+        self.groq_calls = 0
+        self.groq_errors = 0
+        self.rng = random.Random(args.seed)
+
+    async def login(self, request):
+        return web.json_response({"token": "bench-token"})
+
+    async def completions(self, request):
+        self.groq_calls += 1
+        body = await request.json()
+        delay = max(0.0, self.rng.gauss(self.args.groq_latency_ms, self.args.groq_jitter_ms) / 1000)
+        roll = self.rng.random()
+        if roll < self.args.groq_error_rate:
+            self.groq_errors += 1
+            await asyncio.sleep(delay / 4)
+            if roll < self.args.groq_error_rate / 2:
+                return web.json_response({"error": "rate limited"}, status=429, headers={"Retry-After": "1"})
+            return web.json_response({"error": "upstream failure"}, status=500)
+        words = ("Hmph fine I will answer but only because you asked nicely this once baka").split()
+        if not body.get("stream"):
+            await asyncio.sleep(delay)
+            return web.json_response({"choices": [{"message": {"role": "assistant", "content": " ".join(words)}}]})
+
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        await asyncio.sleep(delay / 3)
+        for word in words:
+            chunk = {"choices": [{"delta": {"content": word + " "}}]}
+            try:
+                await response.write(f"data: {json.dumps(chunk)}\n\n".encode())
+            except ConnectionResetError:
+                return response
+            await asyncio.sleep(delay * 2 / 3 / len(words))
+        await response.write(b"data: [DONE]\n\n")
+        return response
+
+    async def websocket(self, request):
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        self.sockets.append(ws)
+        try:
+            async for message in ws:
+                self.frames_in += 1
+                frame = json.loads(message.data)
+                handler = frame.get("handler")
+                if handler == "login":
+                    await ws.send_str(json.dumps({"handler": "login", "status": "success", "userID": BOT_USER_ID}))
+                elif handler == "joinchatroom":
+                    self.joins += 1
+                    name = frame["name"]
+                    room_id = self.room_ids.setdefault(name, next(self.room_seq))
+                    await ws.send_str(json.dumps({"handler": "joinchatroom", "error": 0, "roomid": room_id, "name": name}))
+                elif handler == "chatroommessage":
+                    self._record_reply(frame)
+        finally:
+            if ws in self.sockets: self.sockets.remove(ws)
+        return ws
+
+    def _record_reply(self, frame):
+        self.replies += 1
+        text = frame.get("text", "")
+        if not text.startswith("@"): return
+        username = text[1:].split(" ", 1)[0].rstrip(",")
+        queue = self.pending.get((frame.get("roomid"), username))
+        if queue:
+            # A coalesced reply answers every line the user sent in the window.
+            now = time.monotonic()
+            while queue: self.latencies.append(now - queue.popleft())
+
+    async def broadcast(self, payload):
+        text = json.dumps(payload)
+        for ws in list(self.sockets):
+            if not ws.closed: await ws.send_str(text)
+
+    def start(self):
+        ready = threading.Event()
+
+        def serve():
+            self.loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(self.loop)
+            application = web.Application()
+            application.router.add_post('/api/login', self.login)
+            application.router.add_post('/openai/v1/chat/completions', self.completions)
+            application.router.add_get('/', self.websocket)
+            runner = web.AppRunner(application, access_log=None)
+            self.loop.run_until_complete(runner.setup())
+            site = web.TCPSite(runner, '127.0.0.1', 0)
+            self.loop.run_until_complete(site.start())
+            self.port = site._server.sockets[0].getsockname()[1]
+            ready.set()
+            self.loop.run_forever()
+
+        threading.Thread(target=serve, name="bench-services", daemon=True).start()
+        ready.wait()
+        return self
+
+    def run(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+# ========================================================================================
+# === TRAFFIC ============================================================================
+# ========================================================================================
+async def drive_traffic(services, args, room_names):
+    rng = random.Random(args.seed + 1)
+    users = [f"user{i}" for i in range(args.users)]
+    interval = 1.0 / args.rate
+    sent = {"mention": 0, "command": 0, "noise": 0, "kick": 0}
+    started_at = time.monotonic()
+    next_at = started_at
+    while time.monotonic() - started_at < args.duration:
+        room_name = rng.choice(room_names)
+        room_id = services.room_ids.get(room_name)
+        if room_id is None:
+            await asyncio.sleep(interval)
+            continue
+        username = rng.choice(users)
+        roll = rng.random()
+        if roll < args.mention_ratio:
+            text = f"@{BOT_USERNAME} {rng.choice(['hi', 'how are you?', 'tell me a joke', 'gm', 'what do you think about cats'])}"
+            services.pending[(room_id, username)].append(time.monotonic())
+            kind = "mention"
+        elif roll < args.mention_ratio + args.command_ratio:
+            text = "!help"
+            kind = "command"
+        else:
+            text = rng.choice(["lol", "anyone here?", "brb", "that's wild", "hello everyone"])
+            kind = "noise"
+        sent[kind] += 1
+        await services.broadcast({"handler": "chatroommessage", "userid": rng.randint(1, 10**6), "username": username, "roomid": room_id, "text": text})
+
+        if args.kick_every and sum(sent.values()) % args.kick_every == 0:
+            sent["kick"] += 1
+            await services.broadcast({"handler": "userkicked", "userid": BOT_USER_ID, "roomid": room_id})
+
+        next_at += interval
+        await asyncio.sleep(max(0.0, next_at - time.monotonic()))
+    return sent, time.monotonic() - started_at
+
+# ========================================================================================
+# === REPORTING ==========================================================================
+# ========================================================================================
+def percentile(values, q):
+    if not values: return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+def rss_mb():
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmRSS:'): return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+def configure_app(args, services):
+    base = f"http://127.0.0.1:{services.port}"
+    os.environ.update({
+        "BOT_USERNAME": BOT_USERNAME,
+        "BOT_PASSWORD": "bench",
+        "GROQ_API_KEY": "bench",
+        "GROQ_API_URL": f"{base}/openai/v1/chat/completions",
+        "GROQ_FALLBACK_MODELS": args.fallback_models,
+        "REPLY_CACHE_ENABLED": "true" if args.reply_cache else "false",
+        "ROOMS_TO_JOIN": ",".join(f"bench{i}" for i in range(args.rooms)),
+        "BOT_ENGINE": args.engine,
+        "GROQ_STREAMING": "true" if args.stream else "false",
+        "MASTERS_LIST": "",
+    })
+    if args.no_ai_limits:
+        os.environ.update({"AI_USER_RATE_PER_MINUTE": "1e9", "AI_USER_BURST": "1000000",
+                           "AI_ROOM_RATE_PER_MINUTE": "1e9", "AI_ROOM_BURST": "1000000"})
+    os.environ.pop("SUPABASE_URL", None)
+    sys.path.insert(0, ROOT)
+    import app
+    if not args.verbose: logging.getLogger().setLevel(logging.WARNING)
+
+    app.Config.LOGIN_URL = f"{base}/api/login"
+    app.Config.WS_URL = f"ws://127.0.0.1:{services.port}/"
+    app.supabase = FakeSupabase(latency=args.db_latency_ms / 1000)
+    if args.storage == "sqlite":
+        app.storage = app.SQLiteStorage(os.path.join(tempfile.mkdtemp(prefix="enisa-bench-"), "bench.db"))
+    else:
+        app.storage = app.SupabaseStorage(app.supabase)
+    app.initialize_database()
+    return app
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline load test against local Howdies/Groq/Supabase stand-ins.")
+    parser.add_argument("--rooms", type=int, default=10)
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--rate", type=float, default=20, help="chat lines per second across all rooms")
+    parser.add_argument("--duration", type=float, default=20, help="seconds of traffic")
+    parser.add_argument("--mention-ratio", type=float, default=0.3)
+    parser.add_argument("--command-ratio", type=float, default=0.05)
+    parser.add_argument("--kick-every", type=int, default=0, help="kick the bot after every N lines (0 = never)")
+    parser.add_argument("--groq-latency-ms", type=float, default=300)
+    parser.add_argument("--groq-jitter-ms", type=float, default=100)
+    parser.add_argument("--groq-error-rate", type=float, default=0.0)
+    parser.add_argument("--fallback-models", default="", help="comma-separated extra models to hedge/fall back to")
+    parser.add_argument("--reply-cache", action="store_true", help="enable the short-prompt reply cache")
+    parser.add_argument("--no-ai-limits", action="store_true", help="lift the per-user/per-room AI rate limits")
+    parser.add_argument("--db-latency-ms", type=float, default=20, help="simulated Supabase round trip")
+    parser.add_argument("--storage", choices=["supabase", "sqlite"], default="supabase",
+                        help="fake Supabase (with --db-latency-ms) or a temporary SQLite file")
+    parser.add_argument("--engine", choices=["threaded", "asyncio"], default="threaded")
+    parser.add_argument("--stream", action="store_true", help="use streaming Groq completions")
+    parser.add_argument("--drain", type=float, default=10, help="seconds to wait for outstanding replies")
+    parser.add_argument("--seed", type=int, default=7)
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    parser.add_argument("--verbose", action="store_true", help="keep the bot's INFO logging")
+    args = parser.parse_args()
+
+    services = FakeServices(args).start()
+    app = configure_app(args, services)
+    baseline_threads = threading.active_count()
+
+    connect_started = time.monotonic()
+    app.start_bot_logic()
+    room_names = [f"bench{i}" for i in range(args.rooms)]
+    while len(services.room_ids) < args.rooms and time.monotonic() - connect_started < 60:
+        time.sleep(0.05)
+    ready_after = time.monotonic() - connect_started
+
+    sent, traffic_seconds = services.run(drive_traffic(services, args, room_names))
+    peak_threads = threading.active_count()
+    drain_deadline = time.monotonic() + args.drain
+    while any(services.pending.values()) and time.monotonic() < drain_deadline:
+        time.sleep(0.1)
+
+    app.stop_bot_logic()
+    total_lines = sum(sent[kind] for kind in ("mention", "command", "noise"))
+    unanswered = sum(len(queue) for queue in services.pending.values())
+    report = {
+        "engine": args.engine,
+        "storage": args.storage,
+        "streaming": args.stream,
+        "rooms": args.rooms,
+        "ready_after_s": round(ready_after, 2),
+        "traffic_seconds": round(traffic_seconds, 2),
+        "lines_sent": sent,
+        "inbound_lines_per_s": round(total_lines / traffic_seconds, 1) if traffic_seconds else 0.0,
+        "bot_frames_received": services.frames_in,
+        "replies": services.replies,
+        "replies_per_s": round(services.replies / traffic_seconds, 1) if traffic_seconds else 0.0,
+        "mentions_answered": len(services.latencies),
+        "mentions_unanswered": unanswered,
+        "reply_latency_ms": {
+            "p50": round(percentile(services.latencies, 0.50) * 1000, 1),
+            "p95": round(percentile(services.latencies, 0.95) * 1000, 1),
+            "p99": round(percentile(services.latencies, 0.99) * 1000, 1),
+            "max": round(max(services.latencies, default=0) * 1000, 1),
+        },
+        "groq_calls": services.groq_calls,
+        "groq_errors": services.groq_errors,
+        "llm": app.llm_router.stats(),
+        "rate_limits": {key: value for key, value in app.ai_limiter.stats().items() if not isinstance(value, dict)},
+        "governor": app.llm_governor.stats(),
+        "reply_cache": app.reply_cache.stats(),
+        "supabase_calls": {f"{table}.{operation}": count for (table, operation), count in sorted(app.supabase.calls.items())},
+        "threads": {"baseline": baseline_threads, "peak": peak_threads},
+        "rss_mb": round(rss_mb(), 1),
+        "stages": app.metrics.snapshot()["stages"],
+    }
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return
+    print(f"\n=== Load test: {args.engine} engine, {args.storage} storage, {args.rooms} rooms, {args.rate}/s for {args.duration}s ===")
+    for key in ("ready_after_s", "inbound_lines_per_s", "lines_sent", "replies", "replies_per_s", "mentions_answered",
+                "mentions_unanswered", "reply_latency_ms", "groq_calls", "groq_errors", "llm", "rate_limits", "governor", "reply_cache", "supabase_calls", "threads", "rss_mb"):
+        print(f"{key:>22}: {report[key]}")
+    print("\n  stage latencies (ms):")
+    for stage, row in report["stages"].items():
+        print(f"    {stage:<28} n={row['count']:<6} p50={row['p50_ms']:<8} p95={row['p95_ms']:<8} p99={row['p99_ms']}")
+
+if __name__ == "__main__":
+    main()
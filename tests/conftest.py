@@ -0,0 +1,48 @@
+import os
+import sys
+import tempfile
+import threading
+import time
+
+import pytest
+
+# app.py configures itself from the environment at import time, so pin everything to offline
+# defaults (a throwaway SQLite file, no Supabase, no sharding) before any test imports it.
+TEST_DIR = tempfile.mkdtemp(prefix="enisa-tests-")
+os.environ.update({
+    "STORAGE_BACKEND": "sqlite",
+    "SQLITE_PATH": os.path.join(TEST_DIR, "app.db"),
+    "SUPABASE_URL": "",
+    "SUPABASE_KEY": "",
+    "SHARDING_ENABLED": "false",
+    "GROQ_API_KEY": "test",
+    "BOT_PASSWORD": "test",
+    "MASTERS_LIST": "",
+})
+os.environ.pop("LLM_PROVIDERS", None)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+@pytest.fixture(autouse=True, scope="session")
+def startup_finished():
+    # Importing app kicks off the default persona sync in the background; let it land before a
+    # test swaps in its own storage.
+    import app
+    for thread in threading.enumerate():
+        if thread.name == "persona-sync": thread.join()
+
+@pytest.fixture
+def wait_until():
+    def wait(predicate, timeout=2.0):
+        deadline = time.monotonic() + timeout
+        while not predicate():
+            if time.monotonic() > deadline: raise AssertionError("condition not met in time")
+            time.sleep(0.005)
+    return wait
+
+@pytest.fixture
+def sqlite_storage(tmp_path, monkeypatch):
+    import app
+    store = app.SQLiteStorage(str(tmp_path / "test.db"))
+    monkeypatch.setattr(app, "storage", store)
+    yield store
+    store.close()
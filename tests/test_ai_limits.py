@@ -0,0 +1,88 @@
+import asyncio
+import threading
+
+import pytest
+
+import app
+from app import AILimiter, ConcurrencyGovernor
+
+def test_limit_grows_by_about_one_per_limit_worth_of_fast_turns():
+    governor = ConcurrencyGovernor(2, 1, 3, 4, 0.5)
+    for _ in range(2):
+        assert governor.try_acquire()
+        governor.release(0.1)
+    assert governor.stats()['limit'] == pytest.approx(2.9)
+    assert governor.stats()['inflight'] == 0
+
+    for _ in range(2):
+        governor.try_acquire()
+        governor.release(0.1)
+    assert governor.stats()['limit'] == 3.0
+    assert governor.stats()['increases'] == 3
+
+def test_slow_turns_and_429s_back_off_once_per_interval():
+    governor = ConcurrencyGovernor(8, 1, 16, 4, 0.5)
+    governor.try_acquire()
+    governor.release(5.0)
+    governor.on_rate_limited()
+    assert governor.stats()['limit'] == 4.0
+    assert governor.stats()['decreases'] == 1
+
+    governor._last_decrease -= 4
+    governor.on_rate_limited()
+    assert governor.stats()['limit'] == 2.0
+
+def test_acquire_waits_for_a_release_or_times_out():
+    governor = ConcurrencyGovernor(1, 1, 1, 4, 0.5)
+    assert governor.acquire(0.1)
+    assert not governor.acquire(0.02)
+    assert governor.stats()['rejected'] == 1
+
+    threading.Timer(0.02, governor.release).start()
+    assert governor.acquire(1.0)
+    assert governor.stats()['inflight'] == 1
+
+def test_cancelled_async_waiter_never_takes_a_slot():
+    governor = ConcurrencyGovernor(1, 1, 1, 4, 0.5)
+    governor.try_acquire()
+
+    async def scenario():
+        waiter = asyncio.ensure_future(governor.acquire_async(5))
+        await asyncio.sleep(0.02)
+        waiter.cancel()
+        with pytest.raises(asyncio.CancelledError): await waiter
+        governor.release()
+        await asyncio.sleep(governor.POLL_SECONDS * 2)
+        assert governor.stats()['inflight'] == 0
+        assert await governor.acquire_async(0.5)
+        assert not await governor.acquire_async(0.02)
+
+    asyncio.run(scenario())
+    assert governor.stats() == {'limit': 1.0, 'inflight': 1, 'increases': 0, 'decreases': 0, 'rejected': 1}
+
+def limiter(master_multiplier=0):
+    return AILimiter(1 / 60, 2, 1 / 60, 3, master_multiplier, 100, 60)
+
+def test_user_then_room_throttling():
+    limits = limiter()
+    assert [limits.check({'name': "Ann"}, 1) for _ in range(3)] == [None, None, 'user']
+    assert limits.check({'name': "Bob"}, 1) is None
+    assert limits.check({'name': "Cat"}, 1) == 'room'
+    assert limits.check({'name': "Cat"}, 2) is None
+    assert limits.stats()['throttled_room'] == 1
+
+def test_masters_are_exempt_or_scaled(monkeypatch):
+    monkeypatch.setattr(app.bot_state, "masters", ["boss"])
+    exempt = limiter()
+    assert all(exempt.check({'name': "Boss"}, 1) is None for _ in range(10))
+    assert exempt.stats()['exempted'] == 10
+
+    scaled = limiter(master_multiplier=2)
+    assert [scaled.check({'name': "Boss"}, 1) for _ in range(5)] == [None] * 4 + ['user']
+    assert scaled.stats()['tracked_rooms'] == 0
+
+def test_one_throttle_notice_per_interval():
+    limits = limiter()
+    assert limits.should_notify("ann")
+    assert not limits.should_notify("ann")
+    assert limits.should_notify("bob")
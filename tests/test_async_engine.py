@@ -0,0 +1,82 @@
+import asyncio
+import threading
+
+import pytest
+import websocket
+
+from app import AsyncBotEngine, AsyncSocketAdapter
+
+def test_submit_without_a_loop_is_refused():
+    assert AsyncBotEngine(10).submit(None, (), 0, 1) is False
+
+def test_lanes_keep_order_and_rooms_run_concurrently():
+    engine = AsyncBotEngine(10)
+    events = []
+
+    async def reply(room_id, text, delay):
+        events.append(("start", room_id, text))
+        await asyncio.sleep(delay)
+        events.append(("end", room_id, text))
+
+    async def scenario():
+        engine.loop = asyncio.get_running_loop()
+        engine.submit(reply, (1, "a1", 0.05), 1, 1)
+        engine.submit(reply, (1, "a2", 0), 1, 1)
+        engine.submit(reply, (2, "b1", 0), 1, 2)
+        while engine.completed < 3: await asyncio.sleep(0.005)
+
+    asyncio.run(scenario())
+    assert events.index(("end", 2, "b1")) < events.index(("end", 1, "a1"))
+    assert events.index(("end", 1, "a1")) < events.index(("start", 1, "a2"))
+    assert engine._locks == {}
+
+def test_overload_is_shed_and_failures_are_contained():
+    engine = AsyncBotEngine(1)
+    shed = []
+    release = None
+
+    async def hold():
+        await release.wait()
+
+    async def boom():
+        raise RuntimeError("boom")
+
+    async def scenario():
+        nonlocal release
+        release = asyncio.Event()
+        engine.loop = asyncio.get_running_loop()
+        engine.submit(hold, (), 1, 1)
+        await asyncio.sleep(0)
+        engine.submit(hold, (), 1, 2, on_shed=lambda: shed.append(2))
+        await asyncio.sleep(0)
+        release.set()
+        while engine.completed < 1: await asyncio.sleep(0.005)
+        engine.submit(boom, (), 1, 3)
+        while engine.completed < 2: await asyncio.sleep(0.005)
+
+    asyncio.run(scenario())
+    assert shed == [2]
+    assert engine.stats()['dropped'] == 1 and engine.stats()['inflight'] == 0
+
+def test_submit_from_a_thread_after_the_loop_closed():
+    engine = AsyncBotEngine(10)
+    engine.loop = asyncio.new_event_loop()
+    engine.loop.close()
+    calls = []
+
+    async def reply():
+        calls.append(1)
+
+    results = []
+    thread = threading.Thread(target=lambda: results.append(engine.submit(reply, (), 1, 1)))
+    thread.start()
+    thread.join()
+    assert results == [False] and calls == []
+
+def test_adapter_send_on_a_closed_loop_looks_like_a_closed_socket():
+    loop = asyncio.new_event_loop()
+    adapter = AsyncSocketAdapter(loop, ws=None)
+    loop.close()
+    with pytest.raises(websocket.WebSocketConnectionClosedException):
+        adapter.send("{}")
+    adapter.close()
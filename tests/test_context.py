@@ -0,0 +1,49 @@
+import pytest
+
+import app
+from app import build_turn, fold_into_summary
+
+@pytest.fixture
+def budget(monkeypatch):
+    monkeypatch.setattr(app.Config, "CONTEXT_TOKEN_BUDGET", 1000)
+    monkeypatch.setattr(app.Config, "MEMORY_LIMIT", 4)
+    monkeypatch.setattr(app.Config, "MAX_MESSAGE_CHARS", 600)
+    monkeypatch.setattr(app.Config, "SUMMARY_MAX_CHARS", 800)
+    return app.Config
+
+def chat(*lines):
+    return [{"role": "user" if index % 2 == 0 else "assistant", "content": line} for index, line in enumerate(lines)]
+
+def test_short_history_is_sent_as_is(budget):
+    stored, messages = build_turn(chat("hi", "hmph"), "how are you", "persona")
+    assert stored == chat("hi", "hmph", "how are you")
+    assert messages == [{"role": "system", "content": "persona"}] + stored
+
+def test_old_turns_are_folded_into_the_summary(budget):
+    stored, messages = build_turn(chat("one", "two", "three", "four"), "five", "persona")
+    assert stored[0] == {"role": "system", "content": "User: one", "summary": True}
+    assert [m["content"] for m in stored[1:]] == ["two", "three", "four", "five"]
+    assert messages[1]["content"].endswith("User: one")
+
+    stored, _ = build_turn(stored + chat("six"), "seven", "persona")
+    assert stored[0]["content"] == "User: one\nYou: two\nUser: three"
+
+def test_token_budget_keeps_at_least_the_new_message(budget):
+    budget.CONTEXT_TOKEN_BUDGET = 50
+    stored, messages = build_turn(chat("a" * 600), "b" * 2000, "persona")
+    assert [m["role"] for m in messages] == ["system", "system", "user"]
+    assert messages[-1]["content"] == "b" * 600 + "…"
+    assert stored[0]["summary"] and len(stored) == 2
+
+def test_summary_is_capped_from_the_oldest_line(budget):
+    budget.SUMMARY_MAX_CHARS = 30
+    summary = None
+    for text in ("first line", "second line", "third   line\nwith a break"):
+        summary = fold_into_summary(summary, {"role": "user", "content": text})
+    assert summary == "User: third line with a break"
+
+def test_history_free_turn_still_records_the_conversation(budget):
+    history = [{"role": "system", "content": "User: old", "summary": True}] + chat("hi", "hmph")
+    stored, messages = build_turn(history, "gm", "persona", include_history=False)
+    assert messages == [{"role": "system", "content": "persona"}, {"role": "user", "content": "gm"}]
+    assert stored == history + [{"role": "user", "content": "gm"}]
@@ -0,0 +1,73 @@
+import pytest
+
+from app import ConversationMemory
+
+@pytest.fixture
+def memory(sqlite_storage):
+    # A long interval keeps the background flusher out of the way unless a batch fills up.
+    memory = ConversationMemory(2, 60, 100)
+    yield memory
+    memory.shutdown()
+
+def turn(text):
+    return [{"role": "user", "content": text}]
+
+def test_writes_stay_in_memory_until_flushed(memory, sqlite_storage):
+    memory.set_history("ann", turn("hi"))
+    assert memory.get_history("ann") == turn("hi")
+    assert sqlite_storage.get_history("ann") == []
+
+    assert memory.flush() == 1
+    assert sqlite_storage.get_history("ann") == turn("hi")
+    assert memory.flush() == 0
+
+def test_evicted_user_is_served_from_the_pending_write(memory):
+    for name in ("ann", "bob", "cat"): memory.set_history(name, turn(name))
+    assert memory.stats()['cached_users'] == 2
+    assert memory.get_history("ann") == turn("ann")
+    assert memory.stats()['misses'] == 0
+
+def test_cold_user_is_loaded_once(memory, sqlite_storage):
+    sqlite_storage.save_histories([{'username': "ann", 'history': turn("stored")}])
+    assert memory.get_history("ann") == turn("stored")
+    assert memory.get_history("ann") == turn("stored")
+    assert memory.stats()['misses'] == 1 and memory.stats()['hits'] == 1
+
+def test_full_batch_wakes_the_flusher(sqlite_storage, wait_until):
+    memory = ConversationMemory(10, 60, 2)
+    memory.set_history("ann", turn("a"))
+    memory.set_history("bob", turn("b"))
+    wait_until(lambda: memory.stats()['rows_written'] == 2)
+    memory.shutdown()
+
+def test_failed_flush_keeps_newer_turns(memory, sqlite_storage, monkeypatch):
+    memory.set_history("ann", turn("old"))
+    save_histories = sqlite_storage.save_histories
+
+    def fail_after_a_newer_turn(rows):
+        memory.set_history("ann", turn("new"))
+        raise RuntimeError("offline")
+
+    monkeypatch.setattr(sqlite_storage, "save_histories", fail_after_a_newer_turn)
+    assert memory.flush() == 0
+    monkeypatch.setattr(sqlite_storage, "save_histories", save_histories)
+    assert memory.flush() == 1
+    assert sqlite_storage.get_history("ann") == turn("new")
+    assert memory.stats()['flush_errors'] == 1
+
+def test_shutdown_flushes_pending_writes(sqlite_storage):
+    memory = ConversationMemory(10, 60, 100)
+    memory.set_history("ann", turn("bye"))
+    memory.shutdown()
+    assert sqlite_storage.get_history("ann") == turn("bye")
+
+def test_write_through_shares_turns_between_processes(sqlite_storage):
+    # Two shard processes serving the same user never overwrite each other's turns.
+    first, second = ConversationMemory(10, 60, 100, write_through=True), ConversationMemory(10, 60, 100, write_through=True)
+    first.set_history("ann", turn("a"))
+    assert sqlite_storage.get_history("ann") == turn("a")
+    assert second.get_history("ann") == turn("a")
+    second.set_history("ann", turn("a") + turn("b"))
+    assert first.peek("ann") is None
+    assert first.get_history("ann") == turn("a") + turn("b")
+    assert first.stats()['cached_users'] == 0
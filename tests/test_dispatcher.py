@@ -0,0 +1,60 @@
+import threading
+
+import pytest
+
+from app import Dispatcher, PRIORITY_CHAT, PRIORITY_MASTER
+
+def blocked_dispatcher(max_queued=10, shed_policy="drop_oldest"):
+    # One worker parked on a gate, so everything submitted afterwards stays queued.
+    dispatcher = Dispatcher(1, max_queued, shed_policy)
+    gate, started = threading.Event(), threading.Event()
+    dispatcher.submit(lambda: (started.set(), gate.wait(2)), (), PRIORITY_CHAT, "blocker")
+    assert started.wait(2)
+    return dispatcher, gate
+
+def test_lane_runs_tasks_in_submission_order(wait_until):
+    dispatcher = Dispatcher(4, 100, "drop_oldest")
+    ran = []
+    for index in range(20): dispatcher.submit(ran.append, (index,), PRIORITY_CHAT, "room-1")
+    wait_until(lambda: dispatcher.stats()['completed'] == 20)
+    assert ran == list(range(20))
+
+def test_master_commands_jump_ahead_of_chat(wait_until):
+    dispatcher, gate = blocked_dispatcher()
+    ran = []
+    dispatcher.submit(ran.append, ("chat",), PRIORITY_CHAT, "room-1")
+    dispatcher.submit(ran.append, ("master",), PRIORITY_MASTER, "room-2")
+    gate.set()
+    wait_until(lambda: len(ran) == 2)
+    assert ran == ["master", "chat"]
+
+def test_busy_policy_sheds_the_new_task(wait_until):
+    dispatcher, gate = blocked_dispatcher(max_queued=1, shed_policy="busy")
+    ran, shed = [], []
+    assert dispatcher.submit(ran.append, ("kept",), PRIORITY_CHAT, "room-1")
+    assert not dispatcher.submit(ran.append, ("shed",), PRIORITY_CHAT, "room-2", on_shed=lambda: shed.append(True))
+    assert shed == [True] and dispatcher.stats()['dropped'] == 1
+    gate.set()
+    wait_until(lambda: ran == ["kept"])
+
+def test_unknown_shed_policy_is_rejected():
+    with pytest.raises(ValueError, match="DISPATCH_SHED_POLICY"):
+        Dispatcher(1, 10, "drop_newest")
+
+def test_drop_oldest_keeps_higher_priority_work(wait_until):
+    dispatcher, gate = blocked_dispatcher(max_queued=2)
+    ran = []
+    dispatcher.submit(ran.append, ("old chat",), PRIORITY_CHAT, "room-1")
+    dispatcher.submit(ran.append, ("new chat",), PRIORITY_CHAT, "room-2")
+    dispatcher.submit(ran.append, ("master",), PRIORITY_MASTER, "room-3")
+    gate.set()
+    wait_until(lambda: dispatcher.stats()['queue_depth'] == 0 and dispatcher.stats()['active'] == 0)
+    assert ran == ["master", "new chat"]
+
+def test_failing_task_does_not_kill_the_worker(wait_until):
+    dispatcher = Dispatcher(1, 10, "drop_oldest")
+    ran = []
+    dispatcher.submit(lambda: 1 / 0, (), PRIORITY_CHAT, "room-1")
+    dispatcher.submit(ran.append, ("after",), PRIORITY_CHAT, "room-1")
+    wait_until(lambda: ran == ["after"])
+    assert dispatcher.stats()['failed'] == 1
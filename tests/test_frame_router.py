@@ -0,0 +1,49 @@
+import json
+
+import pytest
+
+import app
+from app import FrameRouter
+
+def frame(**fields):
+    return json.dumps(fields)
+
+@pytest.fixture
+def router():
+    router = FrameRouter()
+    router.seen = []
+    router.register("login")(router.seen.append)
+    return router
+
+def test_registered_frames_reach_their_handler(router):
+    router.route(frame(handler="login", status="success"))
+    router.route('{"status": "success", "handler" : "login"}')
+    assert [data["status"] for data in router.seen] == ["success", "success"]
+    assert router.stats()['handlers']["login"]['count'] == 2
+
+def test_unregistered_frames_are_dropped_before_parsing(router, monkeypatch):
+    def no_parse(text): raise AssertionError("parsed an unhandled frame")
+    monkeypatch.setattr(app.json, "loads", no_parse)
+    router.route('{"handler": "ping"} not even json')
+    assert router.stats()['unhandled'] == 1
+
+def test_unmatched_handler_field_falls_back_to_the_parsed_value(router):
+    router.route('{"\\u0068andler": "login"}')
+    router.route('{"\\u0068andler": "ping"}')
+    assert len(router.seen) == 1 and router.stats()['unhandled'] == 1
+
+def test_chat_prefilter_skips_lines_not_for_the_bot(monkeypatch):
+    commands = []
+    monkeypatch.setattr(app, "process_command", lambda sender, room_id, text: commands.append(text))
+    monkeypatch.setattr(app.bot_state, "bot_user_id", "0")
+    before = app.frame_router.stats()['handlers']["chatroommessage"]['filtered']
+    for text in ("just chatting", f"hey @{app.Config.BOT_USERNAME}", "!help"):
+        app.on_message(None, frame(handler="chatroommessage", userid="7", username="ann", roomid=1, text=text))
+    assert commands == [f"hey @{app.Config.BOT_USERNAME}", "!help"]
+    assert app.frame_router.stats()['handlers']["chatroommessage"]['filtered'] == before + 1
+
+def test_bot_accounts_are_never_answered(monkeypatch):
+    commands = []
+    monkeypatch.setattr(app, "process_command", lambda sender, room_id, text: commands.append(text))
+    app.on_message(None, frame(handler="chatroommessage", userid="8", username=app.Config.BOT_USERNAME.upper(), roomid=1, text="!help"))
+    assert commands == []
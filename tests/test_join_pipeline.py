@@ -0,0 +1,59 @@
+import pytest
+
+import app
+from app import JoinPipeline
+
+@pytest.fixture
+def sent(monkeypatch):
+    names = []
+    monkeypatch.setattr(app, "join_room", lambda room_name, source=None: names.append(room_name))
+    return names
+
+def test_window_limits_joins_in_flight(sent):
+    pipeline = JoinPipeline(2, 0, 60, 3)
+    pipeline.start(["Lobby", "lobby ", "Music", "Games", ""])
+    assert sent == ["Lobby", "Music"]
+    assert pipeline.stats()['total'] == 3
+
+    pipeline.on_ack({'name': "LOBBY", 'error': 0})
+    assert sent == ["Lobby", "Music", "Games"]
+    pipeline.on_ack({'name': "Music", 'error': 0})
+    pipeline.on_ack({'name': "Games", 'error': 0})
+    stats = pipeline.stats()
+    assert stats['joined'] == 3 and stats['pending'] == 0 and stats['last_duration_s'] is not None
+
+def test_unknown_acks_are_ignored(sent):
+    pipeline = JoinPipeline(1, 0, 60, 3)
+    pipeline.start(["Lobby"])
+    pipeline.on_ack({'name': "Elsewhere", 'error': 0})
+    pipeline.on_ack({'error': 0})
+    assert pipeline.stats()['pending'] == 1
+
+def test_rejected_joins_are_retried_then_given_up(sent):
+    pipeline = JoinPipeline(1, 0, 60, 2)
+    pipeline.start(["Lobby"])
+    pipeline.on_ack({'name': "Lobby", 'error': 5})
+    pipeline.on_ack({'name': "Lobby", 'error': 5})
+    assert sent == ["Lobby", "Lobby"]
+    assert pipeline.stats()['failed'] == ["Lobby"] and pipeline.stats()['retries'] == 1
+
+def test_timed_out_joins_are_retried(sent, wait_until):
+    pipeline = JoinPipeline(1, 0, 0.02, 2)
+    pipeline.start(["Lobby"])
+    wait_until(lambda: pipeline.stats()['failed'] == ["Lobby"])
+    assert sent == ["Lobby", "Lobby"]
+
+    pipeline.start(["Music"])
+    wait_until(lambda: len(sent) == 4)
+    pipeline.on_ack({'name': "Music", 'error': 0})
+    assert pipeline.stats()['joined'] == 1
+
+def test_paced_joins_share_one_wake_up(sent, wait_until):
+    pipeline = JoinPipeline(10, 20, 60, 3)
+    pipeline.start(["A", "B"])
+    pipeline.extend(["C", "b"])
+    pipeline._pump()
+    assert sent == ["A"] and pipeline._pump_scheduled
+    wait_until(lambda: len(sent) == 3, timeout=1)
+    assert sent == ["A", "B", "C"]
+    assert pipeline.stats()['total'] == 3
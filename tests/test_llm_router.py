@@ -0,0 +1,136 @@
+import email.utils
+import time
+
+import pytest
+import requests
+
+import app
+from app import AttemptCancelled, ConcurrencyGovernor, LLMProvider, LLMRouter, RateLimited, parse_retry_after
+
+def http_error(status):
+    response = requests.Response()
+    response.status_code = status
+    return requests.HTTPError(f"{status} error", response=response)
+
+@pytest.fixture
+def replies(monkeypatch):
+    # Maps provider name -> callable(cancelled) standing in for the HTTP request.
+    table = {}
+    monkeypatch.setattr(app, "post_completion", lambda provider, messages, word_limit=None, cancelled=None: table[provider.name](cancelled))
+    monkeypatch.setattr(app, "llm_governor", ConcurrencyGovernor(4, 1, 16, 4, 0.5))
+    return table
+
+def router(*names):
+    return LLMRouter([LLMProvider(name, "http://llm.invalid", "model", "key") for name in names])
+
+def raise_(error):
+    def fail(cancelled): raise error
+    return fail
+
+def test_parse_retry_after_accepts_seconds_and_dates():
+    assert parse_retry_after("7") == 7.0
+    assert parse_retry_after("-3") == 0.0
+    assert parse_retry_after(None) == app.Config.LLM_DEFAULT_RETRY_AFTER_SECONDS
+    assert parse_retry_after("soon") == app.Config.LLM_DEFAULT_RETRY_AFTER_SECONDS
+    in_a_minute = email.utils.formatdate(time.time() + 60, usegmt=True)
+    assert 55 <= parse_retry_after(in_a_minute) <= 60
+
+def test_errors_fall_through_to_the_next_provider(replies):
+    llm = router("primary", "backup")
+    replies["primary"] = raise_(http_error(500))
+    replies["backup"] = lambda cancelled: "from backup"
+    assert llm.complete([]) == "from backup"
+    stats = llm.stats()['providers']
+    assert stats["primary"]['errors'] == 1 and stats["backup"]['wins'] == 1
+
+def test_breaker_opens_on_server_errors_only(replies, monkeypatch):
+    monkeypatch.setattr(app.Config, "LLM_BREAKER_FAILURES", 2)
+    llm = router("bad-request", "down", "backup")
+    replies["bad-request"] = raise_(http_error(400))
+    replies["down"] = raise_(http_error(503))
+    replies["backup"] = lambda cancelled: "ok"
+    for _ in range(3): assert llm.complete([]) == "ok"
+    states = {name: provider['state'] for name, provider in llm.stats()['providers'].items()}
+    assert states == {"bad-request": "closed", "down": "open", "backup": "closed"}
+
+def test_hedge_wins_and_the_slow_attempt_is_cancelled(replies, monkeypatch):
+    monkeypatch.setattr(app.Config, "LLM_HEDGE_DEFAULT_DELAY_SECONDS", 0.05)
+    monkeypatch.setattr(app.Config, "LLM_HEDGE_MIN_DELAY_SECONDS", 0.01)
+    abandoned = []
+
+    def slow(cancelled):
+        abandoned.append(cancelled.wait(2))
+        raise AttemptCancelled()
+
+    llm = router("slow", "fast")
+    replies["slow"] = slow
+    replies["fast"] = lambda cancelled: "hedged"
+    assert llm.complete([]) == "hedged"
+    assert llm.stats()['hedges_won'] == 1
+    llm._executor.shutdown(wait=True)
+    assert abandoned == [True]
+    assert llm.stats()['providers']["slow"]['errors'] == 0
+
+def test_rate_limited_providers_fail_fast(replies):
+    llm = router("only")
+    calls = []
+
+    def limited(cancelled):
+        calls.append(1)
+        raise RateLimited(10)
+
+    replies["only"] = limited
+    with pytest.raises(RateLimited):
+        llm.complete([])
+    with pytest.raises(RateLimited) as info:
+        llm.complete([])
+    assert 9 < info.value.retry_after <= 10
+    assert len(calls) == 1
+    assert app.llm_governor.stats()['decreases'] == 1
+
+def test_malformed_provider_list_falls_back_to_groq(monkeypatch):
+    monkeypatch.setattr(app.Config, "GROQ_FALLBACK_MODELS", "")
+    for malformed in ("not json", '{"name": "x"}', '[{"name": "x", "api_key": "k"}]'):
+        monkeypatch.setattr(app.Config, "LLM_PROVIDERS", malformed)
+        assert [provider.name for provider in app.build_llm_providers()] == [f"groq:{app.Config.GROQ_MODEL}"]
+
+    monkeypatch.setenv("OTHER_KEY", "secret")
+    monkeypatch.setattr(app.Config, "LLM_PROVIDERS", '[{"name": "other", "url": "http://llm.invalid", "model": "m", "api_key_env": "OTHER_KEY"}]')
+    [provider] = app.build_llm_providers()
+    assert (provider.name, provider.api_key) == ("other", "secret")
+
+def test_a_lone_provider_is_only_hedged_on_request(replies, monkeypatch):
+    monkeypatch.setattr(app.Config, "LLM_HEDGE_DEFAULT_DELAY_SECONDS", 0.02)
+    monkeypatch.setattr(app.Config, "LLM_HEDGE_MIN_DELAY_SECONDS", 0.01)
+    calls = []
+
+    def slow(cancelled):
+        calls.append(1)
+        if len(calls) == 1: cancelled.wait(0.2)
+        return f"reply {len(calls)}"
+
+    replies["only"] = slow
+    llm = router("only")
+    assert llm.complete([]) == "reply 1"
+    assert llm.stats()['hedges_fired'] == 0
+
+    calls.clear()
+    monkeypatch.setattr(app.Config, "LLM_HEDGE_SAME_PROVIDER", True)
+    assert llm.complete([]) == "reply 2"
+    assert llm.stats()['hedges_won'] == 1
+
+def test_wait_only_counts_blocked_providers(replies):
+    llm = router("half-open", "limited")
+    half_open, limited = llm.providers
+    now = time.monotonic()
+    half_open.open_until, half_open.trial_inflight = now - 5, True
+    limited.retry_after_until = now + 3
+    with pytest.raises(RateLimited) as info:
+        llm.complete([])
+    assert 2 < info.value.retry_after <= 3
+
+    limited.retry_after_until = 0.0
+    limited.open_until, limited.trial_inflight = now - 5, True
+    with pytest.raises(RateLimited) as info:
+        llm.complete([])
+    assert info.value.retry_after == app.Config.LLM_DEFAULT_RETRY_AFTER_SECONDS > 0
@@ -0,0 +1,43 @@
+import time
+
+from app import MessageCoalescer
+
+ANN, BOB = {'name': "Ann"}, {'name': "Bob"}
+
+def collector():
+    turns = []
+    return turns, lambda prompt, sender, room_id: turns.append((prompt, sender['name'], room_id))
+
+def test_zero_window_dispatches_immediately():
+    turns, on_ready = collector()
+    coalescer = MessageCoalescer(0, 0, on_ready)
+    coalescer.add("hi", ANN, 1)
+    assert turns == [("hi", "Ann", 1)]
+
+def test_back_to_back_lines_become_one_turn(wait_until):
+    turns, on_ready = collector()
+    coalescer = MessageCoalescer(0.05, 1, on_ready)
+    for line in ("wait", "actually", "never mind"): coalescer.add(line, ANN, 1)
+    coalescer.add("hello", BOB, 1)
+    coalescer.add("hello", ANN, 2)
+    wait_until(lambda: len(turns) == 3)
+    assert sorted(turns) == [("hello", "Ann", 2), ("hello", "Bob", 1), ("wait\nactually\nnever mind", "Ann", 1)]
+    assert coalescer.stats() == {'prompts_received': 5, 'llm_turns': 3, 'llm_calls_saved': 2, 'pending': 0}
+
+def test_max_wait_caps_a_never_ending_burst(wait_until):
+    turns, on_ready = collector()
+    coalescer = MessageCoalescer(0.05, 0.1, on_ready)
+    deadline = time.monotonic() + 0.3
+    while time.monotonic() < deadline:
+        coalescer.add("spam", ANN, 1)
+        time.sleep(0.01)
+    assert len(turns) >= 2
+    wait_until(lambda: coalescer.stats()['pending'] == 0)
+
+def test_clear_drops_pending_prompts():
+    turns, on_ready = collector()
+    coalescer = MessageCoalescer(0.05, 1, on_ready)
+    coalescer.add("hi", ANN, 1)
+    coalescer.clear()
+    time.sleep(0.1)
+    assert turns == [] and coalescer.stats()['pending'] == 0
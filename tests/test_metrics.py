@@ -0,0 +1,43 @@
+import pytest
+
+import app
+from app import Histogram, Metrics
+
+def test_histogram_quantiles_stay_within_observed_values():
+    histogram = Histogram()
+    for ms in range(1, 101): histogram.observe(ms / 1000)
+    assert histogram.count == 100 and histogram.min == 0.001 and histogram.max == 0.1
+    assert 0.04 <= histogram.quantile(0.5) <= 0.06
+    assert 0.09 <= histogram.quantile(0.95) <= 0.1
+    assert histogram.quantile(1.0) == pytest.approx(0.1)
+    assert Histogram().quantile(0.5) == 0.0
+
+def test_slow_outliers_land_in_the_overflow_bucket():
+    histogram = Histogram()
+    histogram.observe(45.0)
+    assert histogram.counts[-1] == 1
+    assert histogram.quantile(0.99) == 45.0
+
+def test_snapshot_and_prometheus_output():
+    metrics = Metrics()
+    with metrics.timer("groq_request"): pass
+    metrics.observe("groq_request", 0.2)
+    metrics.inc("ai_replies", 2)
+    snapshot = metrics.snapshot()
+    assert snapshot['stages']["groq_request"]['count'] == 2
+    assert snapshot['counters'] == {"ai_replies": 2}
+
+    lines = metrics.prometheus_lines()
+    assert 'enisa_stage_duration_seconds_bucket{stage="groq_request",le="+Inf"} 2' in lines
+    assert 'enisa_stage_duration_seconds_bucket{stage="groq_request",le="0.25"} 2' in lines
+    assert 'enisa_events_total{event="ai_replies"} 2' in lines
+
+def test_metrics_endpoints_require_a_login_or_the_key():
+    client = app.app.test_client()
+    assert client.get("/metrics").status_code == 401
+    assert client.get("/metrics.json").status_code == 401
+
+    response = client.get(f"/metrics?key={app.Config.UPTIME_SECRET_KEY}")
+    assert response.status_code == 200
+    assert 'enisa_component{component="bot",field="connected"}' in response.get_data(as_text=True)
+    assert "dispatch" in client.get(f"/metrics.json?key={app.Config.UPTIME_SECRET_KEY}").get_json()['components']
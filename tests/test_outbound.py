@@ -0,0 +1,83 @@
+import json
+
+import pytest
+
+import app
+from app import OutboundSender, TokenBucket
+
+class FakeSocket:
+    def __init__(self):
+        self.frames = []
+
+    def send(self, text):
+        self.frames.append(json.loads(text))
+
+@pytest.fixture
+def socket(monkeypatch):
+    ws = FakeSocket()
+    monkeypatch.setattr(app.bot_state, "ws_instance", ws)
+    monkeypatch.setattr(app.bot_state, "is_connected", True)
+    monkeypatch.setattr(app.bot_state, "is_logged_in", True)
+    return ws
+
+def chat(room_id, text="hi"):
+    return {"handler": "chatroommessage", "type": "text", "roomid": room_id, "text": text}
+
+def test_token_bucket_allows_a_burst_then_paces():
+    bucket = TokenBucket(10, 2)
+    now = bucket.updated_at
+    assert bucket.try_take(now) and bucket.try_take(now)
+    assert not bucket.try_take(now)
+    assert bucket.wait_time(now) == pytest.approx(0.1)
+    assert bucket.try_take(now + 0.11)
+
+@pytest.mark.parametrize("rate, capacity", [(0, 5), (-1, 5), (1, 0)])
+def test_token_bucket_rejects_unusable_limits(rate, capacity):
+    with pytest.raises(ValueError):
+        TokenBucket(rate, capacity)
+
+def test_sender_rejects_an_empty_queue():
+    with pytest.raises(ValueError):
+        OutboundSender(0, 10, 10, 1, 1, 60)
+
+def test_chat_waits_for_login_but_control_frames_do_not(socket, monkeypatch, wait_until):
+    monkeypatch.setattr(app.bot_state, "is_logged_in", False)
+    sender = OutboundSender(10, 1000, 100, 1000, 100, 60)
+    sender.enqueue(chat(1))
+    sender.enqueue({"handler": "login", "username": "Enisa"})
+    wait_until(lambda: len(socket.frames) == 1)
+    assert socket.frames[0]["handler"] == "login"
+
+    app.bot_state.is_logged_in = True
+    sender.notify()
+    wait_until(lambda: len(socket.frames) == 2)
+    assert socket.frames[1]["roomid"] == 1
+
+def test_rooms_are_drained_round_robin(socket, wait_until):
+    sender = OutboundSender(10, 1000, 100, 1000, 100, 60)
+    with sender._cond:
+        for text in ("a1", "a2"): sender.enqueue(chat(1, text))
+        sender.enqueue(chat(2, "b1"))
+    wait_until(lambda: len(socket.frames) == 3)
+    assert [frame["text"] for frame in socket.frames] == ["a1", "b1", "a2"]
+
+def test_full_queue_drops_the_oldest_message(monkeypatch):
+    monkeypatch.setattr(app.bot_state, "is_connected", False)
+    sender = OutboundSender(2, 1000, 100, 1000, 100, 60)
+    for index in range(3): sender.enqueue(chat(index, f"m{index}"))
+    stats = sender.stats()
+    assert stats['dropped'] == 1 and stats['queued_chat'] == 2
+    assert "0" not in sender._rooms
+    # Its writer thread may only get scheduled after the next test reconnects the socket.
+    sender.clear()
+
+def test_idle_room_buckets_are_forgotten(socket, wait_until):
+    sender = OutboundSender(10, 1000, 100, 1000, 100, 60)
+    for room_id in range(5): sender.enqueue(chat(room_id))
+    wait_until(lambda: len(socket.frames) == 5)
+    assert sender.stats()['room_buckets'] == 5
+
+    sender._next_bucket_sweep = 0
+    sender.enqueue(chat(99))
+    wait_until(lambda: len(socket.frames) == 6)
+    assert sender.stats()['room_buckets'] == 1
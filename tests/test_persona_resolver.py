@@ -0,0 +1,59 @@
+import app
+from app import PersonaResolver
+
+ANN = {'name': "Ann"}
+
+def test_lookups_are_cached_until_the_room_is_invalidated(sqlite_storage):
+    sqlite_storage.upsert_personalities([{'name': "tsundere", 'prompt': "Hmph.", 'style': "small_caps"},
+                                         {'name': "siren", 'prompt': "Darling.", 'style': "none"}])
+    resolver = PersonaResolver(60, 10)
+    assert resolver.resolve(ANN, 1) == ("Hmph.", "small_caps", "tsundere")
+
+    sqlite_storage.set_room_personality(1, "siren")
+    assert resolver.resolve({'name': "ANN"}, "1") == ("Hmph.", "small_caps", "tsundere")
+    resolver.invalidate_room(1)
+    assert resolver.resolve(ANN, 1) == ("Darling.", "none", "siren")
+    assert resolver.stats()['hits'] == 1 and resolver.stats()['misses'] == 2
+
+def test_user_behavior_overrides_the_room(sqlite_storage):
+    sqlite_storage.set_user_behavior("ann", "be nice")
+    resolver = PersonaResolver(60, 10)
+    prompt, style, personality = resolver.resolve(ANN, 1)
+    assert '"be nice"' in prompt and style == "small_caps" and personality is None
+
+    sqlite_storage.delete_user_behavior("ann")
+    resolver.invalidate_user("ann")
+    assert resolver.resolve(ANN, 1)[2] == app.Config.DEFAULT_PERSONALITY
+
+def test_personality_invalidation_only_drops_its_users(sqlite_storage):
+    sqlite_storage.upsert_personalities([{'name': "siren", 'prompt': "Darling.", 'style': "none"}])
+    sqlite_storage.set_room_personality(2, "siren")
+    resolver = PersonaResolver(60, 10)
+    resolver.resolve(ANN, 1)
+    resolver.resolve(ANN, 2)
+    resolver.invalidate_personality("SIREN")
+    assert resolver.peek(ANN, 1) is not None
+    assert resolver.peek(ANN, 2) is None
+
+def test_expired_and_evicted_entries_are_reloaded(sqlite_storage):
+    resolver = PersonaResolver(60, 2)
+    for room_id in range(3): resolver.resolve(ANN, room_id)
+    assert resolver.peek(ANN, 0) is None
+    assert resolver.stats()['evictions'] == 1
+
+    expired = PersonaResolver(0, 10)
+    expired.resolve(ANN, 1)
+    assert expired.peek(ANN, 1) is None
+
+def test_lookup_racing_an_invalidation_is_not_cached(sqlite_storage, monkeypatch):
+    resolver = PersonaResolver(60, 10)
+    load = resolver._load
+
+    def load_then_invalidate(sender, room_id):
+        result = load(sender, room_id)
+        resolver.invalidate_room(room_id)
+        return result
+
+    monkeypatch.setattr(resolver, "_load", load_then_invalidate)
+    assert resolver.resolve(ANN, 1)[2] == app.Config.DEFAULT_PERSONALITY
+    assert resolver.stats()['entries'] == 0
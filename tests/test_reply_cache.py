@@ -0,0 +1,111 @@
+import threading
+
+import pytest
+
+import app
+from app import ConversationMemory, PersonaResolver, ReplyCache
+
+real_call_groq = app.call_groq
+
+PROMPTS = "hi, gm,gn,Good Morning,"
+
+def test_only_allowlisted_prompts_get_a_key():
+    cache = ReplyCache(True, 60, 10, 2, PROMPTS)
+    assert cache.key("Hiii!!", "persona", "none") == cache.key("hi", "persona", "none")
+    assert cache.key("good   morning!", "persona", "none") is not None
+    assert cache.key("hi", "persona", "none") != cache.key("hi", "other persona", "none")
+    for contextual in ("why?", "no", "yes please", "tell me more", "?!"):
+        assert cache.key(contextual, "persona", "none") is None
+    assert ReplyCache(False, 60, 10, 2, PROMPTS).key("hi", "persona", "none") is None
+
+def test_replies_are_served_after_enough_variants_without_repeating():
+    cache = ReplyCache(True, 60, 10, 2, PROMPTS)
+    key = cache.key("gm", "persona", "none")
+    cache.put(key, "Morning.")
+    assert cache.get(key) is None
+    cache.put(key, "Hmph, morning.")
+    served = [cache.get(key) for _ in range(4)]
+    assert set(served) == {"Morning.", "Hmph, morning."}
+    assert all(a != b for a, b in zip(served, served[1:]))
+
+def test_entries_expire_and_are_evicted():
+    cache = ReplyCache(True, 0, 10, 1, PROMPTS)
+    key = cache.key("gm", "persona", "none")
+    cache.put(key, "Morning.")
+    assert cache.get(key) is None
+
+    small = ReplyCache(True, 60, 1, 1, PROMPTS)
+    small.put(small.key("gm", "p", "none"), "Morning.")
+    small.put(small.key("gn", "p", "none"), "Night.")
+    assert small.get(small.key("gm", "p", "none")) is None
+    assert small.get(small.key("gn", "p", "none")) == "Night."
+
+@pytest.fixture
+def bot(sqlite_storage, monkeypatch):
+    sqlite_storage.upsert_personalities([{'name': "siren", 'prompt': "Be a siren.", 'style': "none"}])
+    sqlite_storage.set_room_personality(1, "siren")
+    memory = ConversationMemory(10, 60, 100)
+    prompts, room = [], []
+
+    def call_groq(messages, word_limit=None):
+        prompts.append(messages)
+        return f"reply {len(prompts)}"
+
+    monkeypatch.setattr(app, "reply_cache", ReplyCache(True, 60, 10, 1, PROMPTS))
+    monkeypatch.setattr(app, "persona_resolver", PersonaResolver(60, 10))
+    monkeypatch.setattr(app, "conversation_memory", memory)
+    monkeypatch.setattr(app, "llm_governor", app.ConcurrencyGovernor(4, 1, 16, 4, 0.5))
+    monkeypatch.setattr(app, "call_groq", call_groq)
+    monkeypatch.setattr(app, "reply_to_room", lambda room_id, text: room.append(text))
+    yield prompts, room, memory
+    memory.shutdown()
+
+def test_cacheable_turns_never_carry_another_users_history(bot):
+    prompts, room, memory = bot
+    app.get_ai_response("tell me something about cats", {'name': "Ann"}, 1)
+    app.get_ai_response("hi", {'name': "Ann"}, 1)
+    assert [m["content"] for m in prompts[1]] == ["Be a siren.", "hi"]
+
+    app.get_ai_response("hi!", {'name': "Bob"}, 1)
+    assert len(prompts) == 2
+    assert room == ["@Ann reply 1", "@Ann reply 2", "@Bob reply 2"]
+
+def test_cache_hits_are_remembered(bot):
+    prompts, room, memory = bot
+    app.get_ai_response("hi", {'name': "Ann"}, 1)
+    app.get_ai_response("hi", {'name': "Bob"}, 1)
+    assert len(prompts) == 1
+    assert memory.get_history("bob") == [{"role": "user", "content": "hi"}, {"role": "assistant", "content": "reply 1"}]
+    assert app.llm_governor.stats()['inflight'] == 0
+
+def test_short_follow_ups_keep_the_conversation(bot):
+    prompts, room, memory = bot
+    app.get_ai_response("tell me something about cats", {'name': "Ann"}, 1)
+    app.get_ai_response("why?", {'name': "Ann"}, 1)
+    assert [m["content"] for m in prompts[1]] == ["Be a siren.", "tell me something about cats", "reply 1", "why?"]
+
+def test_cache_hits_never_wait_for_the_governor(bot, monkeypatch):
+    prompts, room, memory = bot
+    app.get_ai_response("hi", {'name': "Ann"}, 1)
+    monkeypatch.setattr(app, "llm_governor", app.ConcurrencyGovernor(1, 1, 1, 4, 0.5))
+    monkeypatch.setattr(app.Config, "AI_GOVERNOR_MAX_WAIT_SECONDS", 5)
+    app.llm_governor.try_acquire()
+    app.get_ai_response("hi", {'name': "Bob"}, 1)
+    assert room[-1] == "@Bob reply 1"
+    assert app.llm_governor.stats()['rejected'] == 0
+
+def test_governor_wait_happens_outside_the_user_lock(bot, monkeypatch, wait_until):
+    prompts, room, memory = bot
+    monkeypatch.setattr(app, "call_groq", real_call_groq)
+    monkeypatch.setattr(app, "llm_governor", app.ConcurrencyGovernor(1, 1, 1, 4, 0.5))
+    monkeypatch.setattr(app.Config, "AI_GOVERNOR_MAX_WAIT_SECONDS", 0.5)
+    app.llm_governor.try_acquire()
+    turn = threading.Thread(target=app.get_ai_response, args=("tell me about cats", {'name': "Cat"}, 1))
+    turn.start()
+    wait_until(lambda: app.persona_resolver.peek({'name': "Cat"}, 1))
+    lock = app.user_turn_locks.get("cat")
+    assert lock.acquire(timeout=0.3)
+    lock.release()
+    turn.join()
+    assert app.llm_governor.stats()['rejected'] == 1
+    assert room[-1].startswith("@Cat ") and room[-1][5:] in app.THROTTLE_REPLIES['busy']
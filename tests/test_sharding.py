@@ -0,0 +1,110 @@
+import time
+
+from app import ShardCoordinator, plan_room_assignments
+
+ROOMS = ["a", "b", "c", "d", "e"]
+
+def owners(assignments):
+    grouped = {}
+    for room, worker_id in sorted(assignments.items()): grouped.setdefault(worker_id, []).append(room)
+    return grouped
+
+def test_plan_spreads_rooms_evenly():
+    assert owners(plan_room_assignments(ROOMS, ["w1", "w2"], {})) == {"w1": ["a", "c", "e"], "w2": ["b", "d"]}
+    assert plan_room_assignments(ROOMS, [], {"a": "w1"}) == {}
+
+def test_plan_keeps_rooms_in_place_and_moves_only_the_excess():
+    current = {room: "w1" for room in ROOMS}
+    plan = plan_room_assignments(ROOMS, ["w1", "w2"], current)
+    assert owners(plan) == {"w1": ["a", "b", "c"], "w2": ["d", "e"]}
+    assert plan_room_assignments(ROOMS, ["w1", "w2"], plan) == plan
+
+def test_plan_hands_a_dead_workers_rooms_to_the_survivors():
+    current = {"a": "w1", "b": "w1", "c": "w2", "d": "w2", "e": "w3"}
+    plan = plan_room_assignments(ROOMS, ["w1", "w2"], current)
+    assert {room: plan[room] for room in "abcd"} == {"a": "w1", "b": "w1", "c": "w2", "d": "w2"}
+    assert plan["e"] in ("w1", "w2")
+
+def test_workers_share_accounts_rooms_and_one_leader(tmp_path):
+    path = str(tmp_path / "shards.db")
+    first, second = ShardCoordinator(path, 30), ShardCoordinator(path, 30)
+    accounts = ["Enisa", "Enisa2"]
+    account1, leader1, *_ = first.sync("w1", None, accounts, ROOMS, {})
+    account2, leader2, *_ = second.sync("w2", None, accounts, ROOMS, {})
+    assert (account1, account2) == ("Enisa", "Enisa2")
+    assert (leader1, leader2) == (True, False)
+
+    _, _, assignments, running, _ = first.sync("w1", account1, accounts, ROOMS, {'rooms_joined': 3})
+    assert owners(assignments) == {"w1": ["a", "b", "c"], "w2": ["d", "e"]}
+    assert running is False
+    assert [worker['rooms_joined'] for worker in second.workers() if worker['worker_id'] == "w1"] == [3]
+
+    first.release("w1")
+    account2, leader2, assignments, *_ = second.sync("w2", account2, accounts, ROOMS, {})
+    assert leader2 and set(assignments.values()) == {"w2"} and len(assignments) == 5
+
+def test_expired_leases_can_be_taken_over(tmp_path):
+    path = str(tmp_path / "shards.db")
+    coordinator = ShardCoordinator(path, 0.05)
+    assert coordinator.sync("w1", None, ["Enisa"], ROOMS, {})[:2] == ("Enisa", True)
+    assert coordinator.sync("w2", None, ["Enisa"], ROOMS, {})[:2] == (None, False)
+    time.sleep(0.1)
+    assert coordinator.sync("w2", None, ["Enisa"], ROOMS, {})[:2] == ("Enisa", True)
+    assert coordinator.sync("w1", "Enisa", ["Enisa"], ROOMS, {})[:2] == (None, False)
+
+def test_first_process_decides_the_initial_run_state(tmp_path):
+    path = str(tmp_path / "shards.db")
+    ShardCoordinator(path, 30, auto_start=True)
+    coordinator = ShardCoordinator(path, 30, auto_start=False)
+    assert coordinator.sync("w1", None, ["Enisa"], ROOMS, {})[3] is True
+    coordinator.set_desired_running(False)
+    assert coordinator.sync("w1", "Enisa", ["Enisa"], ROOMS, {})[3] is False
+
+def test_worker_leaves_rooms_that_move_to_another_worker(tmp_path, monkeypatch):
+    import app
+    calls = []
+    monkeypatch.setattr(app.Config, "ROOMS_TO_JOIN", ",".join(ROOMS))
+    monkeypatch.setattr(app, "bot_thread", type("Alive", (), {'is_alive': lambda self: True})())
+    monkeypatch.setattr(app.bot_state, "is_logged_in", True)
+    monkeypatch.setattr(app.bot_state, "room_id_to_name", {index: room.upper() for index, room in enumerate(ROOMS)})
+    monkeypatch.setattr(app, "sync_default_personalities", lambda: None)
+    monkeypatch.setattr(app, "stop_bot_logic", lambda: calls.append("stop"))
+    monkeypatch.setattr(app, "leave_room", lambda room_id: calls.append(("leave", room_id)))
+    monkeypatch.setattr(app.join_pipeline, "extend", lambda rooms: calls.append(("join", sorted(rooms))))
+
+    coordinator = ShardCoordinator(str(tmp_path / "shards.db"), 30, auto_start=True)
+    first = app.ShardWorker(coordinator, {"Enisa": "pw", "Enisa2": "pw"}, 60)
+    second = app.ShardWorker(coordinator, {"Enisa": "pw", "Enisa2": "pw"}, 60)
+    first.worker_id, second.worker_id = "w1", "w2"
+
+    first.tick()
+    assert calls == [("join", ROOMS)]
+    second.tick()
+    first.tick()
+    assert sorted(calls[1:]) == [("leave", 3), ("leave", 4)]
+    assert sorted(app.bot_state.room_id_to_name.values()) == ["A", "B", "C"]
+    assert first.owns_room(0) and not first.owns_room(3)
+
+def test_persona_changes_reach_every_worker(tmp_path, monkeypatch):
+    import app
+    monkeypatch.setattr(app.Config, "ROOMS_TO_JOIN", "")
+    monkeypatch.setattr(app, "bot_thread", None)
+    for field in ("username", "password"): monkeypatch.setattr(app.bot_state, field, getattr(app.bot_state, field))
+    monkeypatch.setattr(app, "sync_default_personalities", lambda: None)
+    cleared = []
+    monkeypatch.setattr(app.persona_resolver, "clear", lambda: cleared.append(1))
+
+    path = str(tmp_path / "shards.db")
+    first = app.ShardWorker(ShardCoordinator(path, 30), {"Enisa": "pw"}, 60)
+    second = app.ShardWorker(ShardCoordinator(path, 30), {"Enisa": "pw"}, 60)
+    first.worker_id, second.worker_id = "w1", "w2"
+    first.tick()
+    second.tick()
+    assert cleared == []
+
+    first.persona_changed()
+    second.tick()
+    assert cleared == [1]
+    second.tick()
+    assert cleared == [1]
+    assert first.coordinator.sync("w1", "Enisa", ["Enisa"], [], {})[4] == 1
@@ -0,0 +1,39 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+import app
+from app import personalities_digest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def test_digest_ignores_order_and_missing_style():
+    rows = {"b": {'prompt': "B", 'style': None}, "a": {'prompt': "A", 'style': "small_caps"}}
+    same = {"a": {'prompt': "A", 'style': "small_caps"}, "b": {'prompt': "B"}}
+    assert personalities_digest(rows) == personalities_digest(same)
+    assert personalities_digest(rows) != personalities_digest(dict(same, b={'prompt': "B2"}))
+
+def test_sync_only_writes_when_the_defaults_changed(sqlite_storage, monkeypatch):
+    writes = []
+    upsert = sqlite_storage.upsert_personalities
+    monkeypatch.setattr(sqlite_storage, "upsert_personalities", lambda rows: writes.append(len(rows)) or upsert(rows))
+    app.initialize_database()
+    app.initialize_database()
+    assert writes == [len(app.DEFAULT_PERSONALITIES)]
+
+    sqlite_storage.upsert_personalities([{'name': "siren", 'prompt': "edited", 'style': "none"}])
+    app.initialize_database()
+    assert len(writes) == 3
+    assert sqlite_storage.get_personality("siren")['prompt'] == app.DEFAULT_PERSONALITIES["siren"]['prompt']
+
+def test_supabase_client_is_not_built_without_credentials():
+    with pytest.raises(RuntimeError):
+        app.get_supabase()
+    assert app.get_http_session() is app.get_http_session()
+
+def test_import_skips_the_heavy_clients():
+    code = "import sys, app; loaded = [m for m in ('supabase', 'aiohttp') if m in sys.modules]; sys.exit(f'imported {loaded}' if loaded else 0)"
+    result = subprocess.run([sys.executable, "-c", code], cwd=ROOT, env=dict(os.environ), capture_output=True, text=True, timeout=60)
+    assert result.returncode == 0, result.stderr[-500:]
@@ -0,0 +1,98 @@
+import threading
+
+import pytest
+
+from app import MirroredStorage, SQLiteStorage
+
+@pytest.fixture
+def store(tmp_path):
+    store = SQLiteStorage(str(tmp_path / "store.db"))
+    yield store
+    store.close()
+
+class RecordingMirror:
+    name = "mirror"
+
+    def __init__(self, fail=False):
+        self.calls = []
+        self.fail = fail
+
+    def __getattr__(self, attr):
+        def record(*args):
+            if self.fail: raise RuntimeError("mirror down")
+            self.calls.append((attr, args))
+        return record
+
+def test_rows_round_trip_and_upserts_replace(store):
+    store.upsert_personalities([{'name': "siren", 'prompt': "v1"}, {'name': "tsundere", 'prompt': "t", 'style': "small_caps"}])
+    store.upsert_personalities([{'name': "siren", 'prompt': "v2", 'style': "none"}])
+    assert store.get_personality("siren") == {'prompt': "v2", 'style': "none"}
+    assert store.get_personalities(["siren", "missing"]) == {"siren": {'prompt': "v2", 'style': "none"}}
+    assert store.get_personalities([]) == {}
+    assert store.list_personality_names() == ["siren", "tsundere"]
+    store.delete_personality("siren")
+    assert store.get_personality("siren") is None
+
+    store.set_room_personality(42, "tsundere")
+    assert store.get_room_personality("42") == "tsundere"
+    store.set_user_behavior("ann", "be nice")
+    store.set_user_behavior("ann", "be mean")
+    assert store.get_user_behavior("ann") == "be mean"
+
+    history = [{"role": "user", "content": "héllo 😒"}]
+    store.save_histories([{'username': "ann", 'history': history}])
+    assert store.get_history("ann") == history
+    assert store.get_history("bob") == []
+
+def test_database_uses_wal_and_a_connection_per_thread(store):
+    assert store._connect().execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+    errors = []
+
+    def write(index):
+        try:
+            store.save_histories([{'username': f"user{index}", 'history': [{"n": index}]}])
+            assert store.get_history(f"user{index}") == [{"n": index}]
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=write, args=(index,)) for index in range(8)]
+    for thread in threads: thread.start()
+    for thread in threads: thread.join()
+    assert errors == []
+    assert len(store._connections) == 9
+
+def test_mirror_replays_writes_in_the_background(store):
+    mirror = RecordingMirror()
+    mirrored = MirroredStorage(store, mirror)
+    mirrored.set_user_behavior("ann", "be nice")
+    assert mirrored.get_user_behavior("ann") == "be nice"
+    mirrored.close()
+    assert mirror.calls == [("set_user_behavior", ("ann", "be nice"))]
+    assert mirrored.stats()['mirrored'] == 1 and mirrored.stats()['backend'] == "sqlite+mirror"
+
+def test_mirror_failures_never_reach_the_caller(store):
+    mirrored = MirroredStorage(store, RecordingMirror(fail=True), max_pending=1)
+    with mirrored._cond:
+        mirrored.set_room_personality(1, "siren")
+        mirrored.set_room_personality(2, "siren")
+    mirrored.close()
+    stats = mirrored.stats()
+    assert stats['mirror_dropped'] == 1 and stats['mirror_errors'] == 1
+
+def test_close_leaves_busy_threads_connections_alone(tmp_path):
+    store = SQLiteStorage(str(tmp_path / "store.db"))
+    started, closed, results = threading.Event(), threading.Event(), []
+
+    def worker():
+        conn = store._connect()
+        started.set()
+        closed.wait(2)
+        results.append(conn.execute("SELECT COUNT(*) FROM conversation_memory").fetchone()[0])
+
+    thread = threading.Thread(target=worker)
+    thread.start()
+    started.wait(2)
+    store.close()
+    closed.set()
+    thread.join()
+    assert results == [0]
@@ -0,0 +1,92 @@
+import json
+
+import pytest
+
+import app
+from app import CompletionStream, LLMProvider, RateLimited, extract_word_limit, trim_to_word_limit
+
+def sse(text):
+    return "data: " + json.dumps({"choices": [{"delta": {"content": text}}]})
+
+class FakeResponse:
+    def __init__(self, status_code=200, lines=(), headers=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+        self.lines = lines
+        self.read = 0
+        self.closed = False
+
+    def raise_for_status(self):
+        pass
+
+    def iter_lines(self):
+        for line in self.lines:
+            self.read += 1
+            yield line
+
+    def close(self):
+        self.closed = True
+
+@pytest.fixture
+def respond(monkeypatch):
+    monkeypatch.setattr(app.Config, "GROQ_STREAMING", True)
+
+    def set_response(response):
+        class Session:
+            def post(self, *args, **kwargs): return response
+        monkeypatch.setattr(app, "get_http_session", Session)
+        return response
+    return set_response
+
+PROVIDER = LLMProvider("groq:test", "http://llm.invalid", "model", "key")
+
+@pytest.mark.parametrize("prompt, limit", [
+    ("Your reply MUST be under 15 words.", 14),
+    ("Keep it to at most 15 words", 15),
+    ("No more than 3 words, please", 3),
+    ("Be brief.", None),
+    (None, None),
+])
+def test_extract_word_limit(prompt, limit):
+    assert extract_word_limit(prompt) == limit
+
+def test_trim_prefers_the_last_full_sentence():
+    assert trim_to_word_limit("Hmph. Fine, I guess you can stay.", 4) == "Hmph."
+    assert trim_to_word_limit("Not like I care at all", 3) == "Not like I"
+    assert trim_to_word_limit("Hi!\nBye now", 5) == "Hi!\nBye now"
+
+def test_stream_stops_after_the_word_limit():
+    stream = CompletionStream(word_limit=3)
+    tokens = ["Oh", " darling.", " You", " again", "?", " Boring"]
+    fed = 0
+    for token in tokens:
+        fed += 1
+        if stream.feed(sse(token)): break
+    assert fed == 4
+    assert stream.result() == "Oh darling."
+
+def test_stream_ignores_keepalives_and_stops_on_done():
+    stream = CompletionStream()
+    assert not stream.feed("")
+    assert not stream.feed(": ping")
+    assert not stream.feed(sse("Hi"))
+    assert stream.feed("data: [DONE]")
+    assert stream.result() == "Hi"
+
+def test_streamed_reply_is_decoded_as_utf8(respond):
+    response = respond(FakeResponse(lines=[sse("Hmph 😒 ").encode(), sse("baka").encode(), b"data: [DONE]"]))
+    assert app.post_completion(PROVIDER, []) == "Hmph 😒 baka"
+    assert response.closed
+
+def test_stream_is_closed_as_soon_as_the_limit_is_hit(respond):
+    lines = [sse(word).encode() for word in ("One ", "two ", "three ", "four ", "five ")]
+    response = respond(FakeResponse(lines=lines))
+    assert app.post_completion(PROVIDER, [], word_limit=2) == "One two"
+    assert response.read == 3 and response.closed
+
+def test_streamed_429_carries_retry_after(respond):
+    response = respond(FakeResponse(status_code=429, headers={"Retry-After": "3"}))
+    with pytest.raises(RateLimited) as info:
+        app.post_completion(PROVIDER, [])
+    assert info.value.retry_after == 3.0
+    assert response.closed
@@ -0,0 +1,44 @@
+import threading
+
+from app import TimerScheduler
+
+def test_timers_fire_in_deadline_order(wait_until):
+    scheduler = TimerScheduler()
+    fired = []
+    scheduler.call_later(0.06, fired.append, "late")
+    scheduler.call_later(0.02, fired.append, "early")
+    scheduler.call_later(0.0, fired.append, "now")
+    wait_until(lambda: len(fired) == 3)
+    assert fired == ["now", "early", "late"]
+
+def test_cancelled_handle_never_fires(wait_until):
+    scheduler = TimerScheduler()
+    fired = []
+    scheduler.call_later(0.02, fired.append, "cancelled").cancel()
+    scheduler.call_later(0.04, fired.append, "kept")
+    wait_until(lambda: fired == ["kept"])
+    assert scheduler.stats()['pending'] == 0
+
+def test_cancel_group_only_touches_that_group(wait_until):
+    scheduler = TimerScheduler()
+    fired = []
+    scheduler.call_later(0.02, fired.append, "bot", group="bot")
+    scheduler.call_later(0.02, fired.append, "bot", group="bot")
+    scheduler.call_later(0.03, fired.append, "connection", group="connection")
+    assert scheduler.cancel_group("bot") == 2
+    wait_until(lambda: fired == ["connection"])
+    assert scheduler.stats()['cancelled'] == 2
+
+def test_earlier_timer_wakes_a_sleeping_scheduler():
+    scheduler = TimerScheduler()
+    done = threading.Event()
+    scheduler.call_later(30, done.set)
+    scheduler.call_later(0.01, done.set)
+    assert done.wait(1)
+
+def test_failing_callback_does_not_stop_the_scheduler(wait_until):
+    scheduler = TimerScheduler()
+    fired = []
+    scheduler.call_later(0.0, lambda: 1 / 0)
+    scheduler.call_later(0.01, fired.append, "after")
+    wait_until(lambda: fired == ["after"])